@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+#
+# Meain TCP protocol client benchmarks
+#
+# Copyright (C) 2018, Andrea Tuccia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import division, print_function, absolute_import
+import binascii
+from collections import OrderedDict as OD
+import os
+import py_compile
+import random
+import socket
+import string
+import subprocess
+import sys
+import threading
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+
+import meian
+
+HEAVY = ['asyncore', 'dicttoxml', 'xmltodict', 'uuid', 'http.server', 'json', 'multiprocessing']
+
+def bench_import(runs = 20, limit = None):
+    py_compile.compile(os.path.join(here, 'meian.py'), doraise=True)
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    times = []
+    for i in range(runs):
+        out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import meian'], cwd=here, env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+        for line in out.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == 'meian':
+                times.append(int(fields[1]))
+    times.sort()
+    check = 'import sys, meian; print(" ".join(m for m in %r if m in sys.modules))' % HEAVY
+    loaded = subprocess.run([sys.executable, '-c', check], cwd=here, env=env, stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout.split()
+    print ('import meian: min %.2fms median %.2fms max %.2fms (%d runs)' % (times[0] / 1000, times[len(times) // 2] / 1000, times[-1] / 1000, len(times)))
+    print ('heavy modules loaded: %s' % (' '.join(loaded) or 'none'))
+    ok = not loaded
+    if limit is not None and times[len(times) // 2] / 1000 > limit:
+        ok = False
+    return ok
+
+ALPHABET = string.ascii_letters + string.digits + ' .,:;_-+=/()[]{}!?@#$%^*~&<>"\'|\t\n\u00e0\u00e8\u00e9\u00f2\u00df\u20ac'
+FIELDS = ['Pos', 'En', 'Name', 'Code', 'Time', 'Type', 'Num', 'Ip', 'Mac', 'Pwd', 'Def', 'Undef', 'Cid', 'Zone', 'Status', 'Bat']
+
+class RandomSource():
+
+    def __init__(self, seed = 0):
+        self.r = random.Random(seed)
+
+    def integer(self, lo, hi):
+        return self.r.randint(lo, hi)
+
+    def choice(self, seq):
+        return self.r.choice(seq)
+
+    def boolean(self):
+        return self.r.random() < 0.5
+
+    def text(self, size, alphabet = ALPHABET):
+        return ''.join(self.r.choice(alphabet) for i in range(self.r.randint(0, size)))
+
+class HypothesisSource():
+
+    def __init__(self, data):
+        from hypothesis import strategies
+        self.st = strategies
+        self.data = data
+
+    def integer(self, lo, hi):
+        return self.data.draw(self.st.integers(lo, hi))
+
+    def choice(self, seq):
+        return self.data.draw(self.st.sampled_from(seq))
+
+    def boolean(self):
+        return self.data.draw(self.st.booleans())
+
+    def text(self, size, alphabet = ALPHABET):
+        return self.data.draw(self.st.text(alphabet, max_size=size))
+
+# Each generator returns the wire value and the value _xmlread must give
+# back. Trailing whitespace is dropped from texts: xmltodict strips it and
+# the protocol has no way to carry it.
+
+def gen_bol(src):
+    v = src.boolean()
+    return meian.BOL(v), v
+
+def gen_s32(src):
+    v = src.integer(-2 ** 31, 2 ** 31 - 1)
+    return meian.S32(v, src.integer(0, 1)), v
+
+def gen_str(src):
+    v = src.text(40).rstrip()
+    return meian.STR(v), v
+
+def gen_pwd(src):
+    v = src.text(16).rstrip()
+    return meian.PWD(v), v
+
+def gen_dta(src):
+    v = (src.integer(2000, 2037), src.integer(1, 12), src.integer(1, 28), src.integer(0, 23), src.integer(0, 59), src.integer(0, 59))
+    return meian.DTA(v + (0, 1, -1)), v
+
+def gen_typ(src):
+    v = src.integer(0, 12)
+    return meian.TYP(v, ['NO', 'DE', 'SI', 'IN', 'FO', 'HO24', 'FI', 'KE', 'GAS', 'WT']), v
+
+def gen_ipa(src):
+    v = '.'.join(str(src.integer(0, 255)) for i in range(4))
+    return meian.IPA(v), v
+
+def gen_mac(src):
+    v = src.choice(':-').join('%02X' % src.integer(0, 255) for i in range(6))
+    return meian.MAC(v), v
+
+def gen_num(src):
+    v = src.text(20, string.digits)
+    return meian.NUM(v), v
+
+def gen_err(src):
+    v = src.integer(0, 99)
+    return 'ERR|%02d' % v, v
+
+def gen_gba(src):
+    v = src.text(16).rstrip()
+    h = binascii.hexlify(v.encode()).decode().upper()
+    return 'GBA,%d|%s' % (len(h) // 2, h), v
+
+def gen_hma(src):
+    v = (src.integer(0, 23), src.integer(0, 59))
+    return 'HMA,5|%02d:%02d' % v, v
+
+def gen_none(src):
+    return None, None
+
+TYPES = OD([('BOL', gen_bol), ('S32', gen_s32), ('STR', gen_str), ('PWD', gen_pwd), ('DTA', gen_dta), ('TYP', gen_typ), ('IPA', gen_ipa), ('MAC', gen_mac), ('NUM', gen_num), ('ERR', gen_err), ('GBA', gen_gba), ('HMA', gen_hma), ('NONE', gen_none)])
+
+def normalize(value):
+    if isinstance(value, time.struct_time):
+        if value.tm_year == 1900:
+            return (value.tm_hour, value.tm_min)
+        return tuple(value)[:6]
+    return value
+
+def command(src):
+    name = 'Cmd%s' % src.text(8, string.ascii_letters)
+    xpath = '/Root/%s/%s' % (src.choice(['Host', 'Pair']), name)
+    cmd = OD()
+    expected = dict()
+    for i in range(src.integer(0, 8)):
+        field = src.choice(FIELDS)
+        kind = src.choice(list(TYPES))
+        cmd[field], expected[field] = TYPES[kind](src)
+    cmd['Err'] = None
+    expected['Err'] = None
+    return xpath, cmd, expected
+
+class Loopback(meian.MeianClient):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._call = meian._Call()
+        self._tokens = set()
+        self.read_timeout = 5
+        self.sock, self.peer = socket.socketpair()
+
+    def __del__(self):
+        self.sock.close()
+        self.peer.close()
+
+    def echo(self, reply = True):
+        data = b''
+        while len(data) < 16 or len(data) < 20 + int(data[4:8]):
+            data += self.peer.recv(65536)
+        if reply:
+            self.peer.sendall(data)
+        return data
+
+    def roundtrip(self, xpath, cmd):
+        # a failed example must not leave stale bytes for the next one
+        self._fill = self._owed = 0
+        self.peer.setblocking(False)
+        try:
+            while self.peer.recv(65536):
+                pass
+        except BlockingIOError:
+            pass
+        self.peer.setblocking(True)
+        self._send(self._create(xpath, cmd))
+        self.echo()
+        return self._select(self._receive(), xpath)
+
+def check(loop, xpath, cmd, expected):
+    try:
+        got = loop.roundtrip(xpath, cmd)
+    except Exception as e:
+        raise AssertionError('%s %r\n  sent %r\n  raised %r' % (xpath, dict(cmd), expected, e))
+    got = dict((k, normalize(v)) for k, v in (got or {}).items())
+    if got != expected:
+        raise AssertionError('%s %r\n  sent %r\n  got  %r' % (xpath, dict(cmd), expected, got))
+
+def bench_codec(examples = 2000, seed = 0, items = 2000):
+    loop = Loopback()
+    try:
+        from hypothesis import given, settings, HealthCheck, strategies
+    except ImportError:
+        given = None
+    try:
+        if given is not None:
+            @settings(max_examples=examples, deadline=None, database=None, suppress_health_check=list(HealthCheck))
+            @given(strategies.data())
+            def prop(data):
+                check(loop, *command(HypothesisSource(data)))
+            prop()
+            print ('round trip: %d hypothesis examples ok' % examples)
+        else:
+            src = RandomSource(seed)
+            for i in range(examples):
+                check(loop, *command(src))
+            print ('round trip: %d random examples ok (seed %d, hypothesis not installed)' % (examples, seed))
+    except AssertionError as e:
+        print ('round trip FAILED: %s' % e)
+        return False
+
+    src = RandomSource(seed)
+    corpus = [command(src) for i in range(items)]
+    fields = sum(len(c[1]) for c in corpus)
+    t = time.perf_counter()
+    frames = []
+    for xpath, cmd, expected in corpus:
+        loop._send(loop._create(xpath, cmd))
+        frames.append(loop.echo(False))
+    encode = time.perf_counter() - t
+    t = time.perf_counter()
+    for frame in frames:
+        loop._decode(memoryview(bytearray(frame)))
+    decode = time.perf_counter() - t
+    t = time.perf_counter()
+    for xpath, cmd, expected in corpus:
+        loop.roundtrip(xpath, cmd)
+    total = time.perf_counter() - t
+    for name, secs in (('encode', encode), ('decode', decode), ('round trip', total)):
+        print ('%-10s %8.1fus/command %6.2fus/field %9.0f commands/s' % (name, secs / items * 1e6, secs / fields * 1e6, items / secs))
+    return True
+
+def xor_bytewise(view):
+    # the original per-byte loop, working on a copy
+    buf = bytearray(view)
+    for i in range(len(buf)):
+        buf[i] ^= meian._KEY[i & 0x7f]
+    return buf
+
+def xor_bigint(view):
+    # whole-frame integers, as before chunking
+    n = len(view)
+    key = int.from_bytes((meian._KEY * (n // len(meian._KEY) + 1))[:n], 'big')
+    view[:] = (int.from_bytes(view, 'big') ^ key).to_bytes(n, 'big')
+
+def peak(func, *args):
+    import tracemalloc
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    func(*args)
+    top = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return top - base
+
+def bench_alloc(sizes = (128, 1024, 4096, 9999), items = 200, seed = 0):
+    loop = Loopback()
+    print ('%-8s %10s %10s %10s' % ('bytes', 'bytewise', 'bigint', 'xorinto'))
+    ok = True
+    for size in sizes:
+        data = bytearray(random.Random(seed).getrandbits(8) for i in range(size))
+        loop._xorinto(memoryview(bytearray(size)))
+        row = [peak(xor_bytewise, memoryview(data)), peak(xor_bigint, memoryview(data)), peak(loop._xorinto, memoryview(data))]
+        print ('%-8d %9dB %9dB %9dB' % ((size,) + tuple(row)))
+        if row[2] > 4 * meian._CHUNK + 512:
+            ok = False
+    src = RandomSource(seed)
+    frames = []
+    for i in range(items):
+        xpath, cmd, expected = command(src)
+        loop._send(loop._create(xpath, cmd))
+        frames.append(loop.echo(False))
+    loop._decode(memoryview(bytearray(frames[0])))
+    decode = sorted(peak(loop._decode, memoryview(bytearray(frame))) for frame in frames)
+    print ('decode peak: median %dB max %dB over %d frames' % (decode[len(decode) // 2], decode[-1], len(decode)))
+    return ok
+
+class SoakPanel(threading.Thread):
+
+    daemon = True
+
+    def __init__(self, alarms, chunk = 1000):
+        threading.Thread.__init__(self)
+        self.alarms = alarms
+        self.srv = socket.socket()
+        self.srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.srv.bind(('127.0.0.1', 0))
+        self.srv.listen(8)
+        self.port = self.srv.getsockname()[1]
+        xor = Loopback()._xor
+        def frame(head, xml, enc = True):
+            xml = xml.encode()
+            return head + b'%04d%04d0000' % (len(xml), 0) + (xor(xml) if enc else xml) + b'0000'
+        self.hello = frame(b'@ieM', '<Root><Pair><Push><Err></Err></Push></Pair></Root>')
+        self.blob = b'%maI' + b''.join(frame(b'@alA' if i % 2 else b'!lmX', '<Root><Host><Alarm><Cid>STR,4|1132</Cid><Zone>S32,0,0|%d</Zone></Alarm></Host></Root>' % (i % 100), i % 2 == 1) for i in range(chunk))
+        self.chunk = chunk
+
+    def run(self):
+        while True:
+            conn, addr = self.srv.accept()
+            try:
+                conn.recv(4096)
+                conn.sendall(self.hello)
+                for i in range(self.alarms // self.chunk):
+                    conn.sendall(self.blob)
+                # hold the line until the client hangs up
+                while conn.recv(4096):
+                    pass
+            except socket.error:
+                pass
+            finally:
+                conn.close()
+
+def usage():
+    with open('/proc/self/statm') as f:
+        rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    return rss, len(os.listdir('/proc/self/fd'))
+
+def bench_soak(alarms = 1000000, cycles = 50, slack = 4 << 20):
+    if not os.path.exists('/proc/self/statm'):
+        print ('soak needs /proc')
+        return False
+    per = max(1000, alarms // cycles // 1000 * 1000)
+    panel = SoakPanel(per)
+    panel.start()
+    got = [0]
+    def handler(alarm):
+        got[0] += 1
+    base = None
+    t = time.perf_counter()
+    for i in range(cycles):
+        with meian.MeianPushClient('127.0.0.1', panel.port, 'admin', handler) as push:
+            while push.alarms < per and push.is_alive():
+                time.sleep(0.01)
+            last = push.resources()
+        if push.is_alive() or push.alarms != per:
+            print ('cycle %d: client %s after %d/%d alarms' % (i, 'still running' if push.is_alive() else 'died', push.alarms, per))
+            return False
+        del push
+        if i == 0:
+            # first cycle pays for lazy imports and buffer warm up
+            base = usage()
+    secs = time.perf_counter() - t
+    rss, fds = usage()
+    left = meian.MeianPushClient.accounting()
+    print ('soak: %d alarms over %d connections in %.1fs (%.0f alarms/s)' % (got[0], cycles, secs, got[0] / secs))
+    print ('last client at close: %s' % ', '.join('%s %d' % kv for kv in last.items()))
+    print ('rss %+.1fKiB (%.1fMiB), fds %+d (%d), live clients %d threads %d sockets %d' % ((rss - base[0]) / 1024, rss / 1048576, fds - base[1], fds, left['Clients'], left['Threads'], left['Sockets']))
+    return rss - base[0] <= slack and fds == base[1] and left['Threads'] == 0 and left['Sockets'] == 0
+
+def main():
+    what = sys.argv[1] if len(sys.argv) > 1 else 'import'
+    if what == 'import':
+        ok = bench_import(limit=float(sys.argv[2]) if len(sys.argv) > 2 else None)
+    elif what == 'codec':
+        ok = bench_codec(int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
+    elif what == 'alloc':
+        ok = bench_alloc()
+    elif what == 'soak':
+        ok = bench_soak(*[int(a) for a in sys.argv[2:4]])
+    else:
+        print ('usage: %s import [LIMIT_MS] | codec [EXAMPLES] | alloc | soak [ALARMS] [CYCLES]' % sys.argv[0])
+        ok = False
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
@@ -20,17 +20,25 @@
 #
 
 from __future__ import division, print_function, absolute_import
-import asyncore
-import binascii
 from collections import OrderedDict as OD
-import dicttoxml
+import contextlib
+import heapq
+import os
+import queue
+import random
 import re
+import selectors
 import socket
+import struct
+import sys
 import time
 import threading
-import uuid
-import xml.etree.ElementTree as ET
-import xmltodict
+import weakref
+import zlib
+
+_KEY = bytes(bytearray.fromhex('0c384e4e62382d620e384e4e44382d300f382b382b0c5a6234384e304e4c372b10535a0c20432d171142444e58422c421157322a204036172056446262382b5f0c384e4e62382d620e385858082e232c0f382b382b0c5a62343830304e2e362b10545a0c3e432e1711384e625824371c1157324220402c17204c444e624c2e12'))
+_CHUNK = 256
+_keyints = dict()
 
 class ConnectionError(Exception):
     pass
@@ -44,14 +52,50 @@ class LoginError(Exception):
 class ResponseError(Exception):
     pass
 
+class DeadlineError(Exception):
+    pass
+
+class CancelledError(Exception):
+    pass
+
+class _Call(threading.local):
+    deadline = None
+    token = None
+
 class MeianClient():
 
     seq = 0
     timeout = 10
-
-    def __init__(self, host, port, uid, pwd):
+    connect_timeout = None
+    login_timeout = None
+    read_timeout = None
+    tick = 0.25
+    bufsize = 4096
+    minread = 1024
+    _buf = None
+    _view = None
+    _fill = 0
+    _owed = 0
+    _call = None
+    _tokens = None
+    _lock = None
+    capture = None
+    scheduler = None
+    panel = None
+    group = None
+
+    def __init__(self, host, port, uid, pwd, connect_timeout = None, login_timeout = None, read_timeout = None, capture = None):
+        if capture is not None:
+            self.capture = capture
+        self._lock = threading.Lock()
+        import uuid
+        self.connect_timeout = connect_timeout or self.connect_timeout or self.timeout
+        self.login_timeout = login_timeout or self.login_timeout or self.timeout
+        self.read_timeout = read_timeout or self.read_timeout or self.timeout
+        self._call = _Call()
+        self._tokens = set()
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.settimeout(self.timeout)
+        self.sock.settimeout(self.connect_timeout)
         try:
             self.sock.connect((host, port))
         except socket.timeout:
@@ -66,13 +110,39 @@ class MeianClient():
         cmd['Err'] = None
         xpath = '/Root/Pair/Client'
         root = self._create(xpath, cmd)
-        self.client = self._(xpath, cmd)
+        try:
+            with self.deadline(self.login_timeout):
+                self.client = self._(xpath, cmd)
+        except DeadlineError:
+            self.sock.close()
+            raise LoginError("Login timeout")
         if self.client['Err']:
-            raise ClientError("Login error")
+            raise LoginError("Login error")
+
+    @contextlib.contextmanager
+    def deadline(self, seconds):
+        prev = self._call.deadline
+        self._call.deadline = time.time() + seconds
+        if prev is not None:
+            self._call.deadline = min(prev, self._call.deadline)
+        try:
+            yield self
+        finally:
+            self._call.deadline = prev
 
-    def __del__(self):
+    def cancel(self):
+        for token in list(self._tokens):
+            token.set()
+
+    def close(self):
         self.sock.close()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def GetAlarmStatus(self):
         cmd = OD()
         cmd['DevStatus'] = None
@@ -376,7 +446,7 @@ class MeianClient():
         cmd['Ln'] = None
         cmd['Err'] = None
         xpath = '/Root/Host/GetWlsList'
-        return self._(xpath, cmd)
+        return self._(xpath, cmd, True)
 
     def SwScan(self):
         cmd = OD()
@@ -604,11 +674,22 @@ class MeianClient():
         return self._(xpath, cmd)
 
     def _(self, xpath, cmd, is_list = False, offset = 0, l = None):
+        if self._call.token is None:
+            # deadline and cancel token belong to the calling thread
+            self._call.token = threading.Event()
+            self._tokens.add(self._call.token)
+            try:
+                return self._(xpath, cmd, is_list, offset, l)
+            finally:
+                self._tokens.discard(self._call.token)
+                self._call.token = None
+        deadline = self._call.deadline
+        if deadline is not None and time.time() >= deadline:
+            raise DeadlineError("Command deadline exceeded")
         if offset > 0:
             cmd['Offset'] = S32(offset)
         root = self._create(xpath, cmd)
-        self._send(root)
-        resp = self._receive()
+        resp = self._roundtrip(xpath, root)
         if is_list == False:
             return self._select(resp, xpath)
         if l is None:
@@ -623,42 +704,187 @@ class MeianClient():
             self._(xpath, cmd, is_list, offset, l)
         return l
 
+    @contextlib.contextmanager
+    def _session(self):
+        # send and receive are serialised; waiting for the session still
+        # honours the caller's own deadline and cancel token
+        deadline = self._call.deadline
+        token = self._call.token
+        wait = self.tick
+        if deadline is not None:
+            wait = max(0, min(wait, deadline - time.time()))
+        while not self._lock.acquire(timeout=wait):
+            if token is not None and token.is_set():
+                raise CancelledError("Command cancelled")
+            if deadline is not None:
+                now = time.time()
+                if now >= deadline:
+                    raise DeadlineError("Command deadline exceeded")
+                wait = min(self.tick, deadline - now)
+        try:
+            yield self
+        finally:
+            self._lock.release()
+
+    def _page(self, xpath, cmd, offset = 0):
+        cmd['Offset'] = S32(offset)
+        resp = self._(xpath, cmd) or {}
+        ln = resp.get('Ln') or 0
+        return resp.get('Total') or 0, [resp.get('L%d' % i) for i in range(ln)]
+
+    def _roundtrip(self, xpath, root):
+        if self.scheduler is None:
+            with self._session():
+                self._send(root)
+                return self._receive()
+        timeout = None
+        if self._call.deadline is not None:
+            timeout = self._call.deadline - time.time()
+        self.scheduler.acquire(self, xpath.rsplit('/', 1)[-1], timeout, self._call.token)
+        started = time.time()
+        error = True
+        try:
+            with self._session():
+                self._send(root)
+                resp = self._receive()
+            error = False
+            return resp
+        finally:
+            self.scheduler.release(self, time.time() - started, error)
+
     def _send(self, root):
-        xml = dicttoxml.dicttoxml(root, attr_type=False, root=False)
-        self.seq += 1
-        mesg = b'@ieM%04d%04d0000%s%04d' % (len(xml), self.seq, self._xor(xml), self.seq)
+        self.seq = self.seq % 9999 + 1
+        mesg = self._encode(root, self.seq)
+        self._record(MeianCapture.OUT, mesg)
         self.sock.send(mesg)
 
+    def _record(self, direction, frame):
+        if self.capture is None:
+            return
+        if frame[0:4] == b'@ieM':
+            xml = self._xor(frame[16:-4])
+            if any(marker in xml for marker in MeianCapture.markers):
+                import xmltodict
+                root = xmltodict.parse(bytes(xml), xml_attribs=False, dict_constructor=OD)
+                frame = self._encode(MeianCapture.redact(root), int(bytes(frame[8:12])))
+        self.capture.write(direction, frame)
+
+    def _encode(self, root, seq):
+        import dicttoxml
+        xml = dicttoxml.dicttoxml(root, attr_type=False, root=False)
+        return b'@ieM%04d%04d0000%s%04d' % (len(xml), seq, self._xor(xml), seq)
+
     def _receive(self):
-        try:
-            data = self.sock.recv(1024)
-            #print (data)
-        except socket.timeout:
-            self.sock.close()
-            raise ConnectionError("Connection error")
-        return xmltodict.parse(self._xor(data[16:-4]).decode(), xml_attribs=False, dict_constructor=dict, postprocessor=self._xmlread)
+        self._owed += 1
+        while True:
+            frame = self._recvframe()
+            size = len(frame)
+            self._record(MeianCapture.IN, frame)
+            if frame[0:4] == b'@ieM':
+                seq = int(frame[8:12].tobytes())
+                if seq == self.seq or (seq == 0 and self._owed == 1):
+                    self._owed = 0
+                    resp = self._decode(frame)
+                    self._consume(size)
+                    return resp
+                self._owed = max(self._owed - 1, 1)
+            self._consume(size)
+
+    def _recvframe(self):
+        frame = self._frame(0)
+        idle = time.time()
+        deadline = self._call.deadline
+        token = self._call.token
+        while frame is None:
+            now = time.time()
+            if token is not None and token.is_set():
+                raise CancelledError("Command cancelled")
+            if deadline is not None and now >= deadline:
+                raise DeadlineError("Command deadline exceeded")
+            if now - idle >= self.read_timeout:
+                self.sock.close()
+                raise ConnectionError("Connection error")
+            wait = min(self.tick, self.read_timeout - (now - idle))
+            if deadline is not None:
+                wait = min(wait, deadline - now)
+            self._reserve(self._fill + self.minread, self._fill)
+            self.sock.settimeout(wait)
+            try:
+                n = self.sock.recv_into(self._view[self._fill:])
+            except socket.timeout:
+                continue
+            if n == 0:
+                self.sock.close()
+                raise ConnectionError("Connection closed")
+            self._fill += n
+            idle = time.time()
+            frame = self._frame(0)
+        return frame
+
+    def _frame(self, start):
+        avail = self._fill - start
+        if avail < 4:
+            return None
+        if self._view[start:start + 4] == b'%maI':
+            return self._view[start:start + 4]
+        if avail < 16:
+            return None
+        size = 16 + int(self._view[start + 4:start + 8].tobytes()) + 4
+        if avail < size:
+            return None
+        return self._view[start:start + size]
+
+    def _consume(self, size):
+        rest = self._fill - size
+        self._view[:rest] = self._view[size:self._fill]
+        self._fill = rest
+
+    def _reserve(self, size, fill = 0):
+        if self._buf is not None and len(self._buf) >= size:
+            return
+        # grow geometrically so a run of partial frames settles quickly
+        buf = bytearray(max(size, self.bufsize, 2 * len(self._buf or b'')))
+        if fill:
+            buf[:fill] = self._view[:fill]
+        self._buf = buf
+        self._view = memoryview(buf)
+
+    def _decode(self, frame):
+        if frame[0:4] != b'!lmX':
+            self._xorinto(frame[16:-4])
+        return self._parse(frame[16:-4])
+
+    def _parse(self, data):
+        import xmltodict
+        return xmltodict.parse(data, xml_attribs=False, dict_constructor=dict, postprocessor=self._xmlread)
 
     def _xor(self, input):
-        sz = bytearray.fromhex('0c384e4e62382d620e384e4e44382d300f382b382b0c5a6234384e304e4c372b10535a0c20432d171142444e58422c421157322a204036172056446262382b5f0c384e4e62382d620e385858082e232c0f382b382b0c5a62343830304e2e362b10545a0c3e432e1711384e625824371c1157324220402c17204c444e624c2e12')
         buf = bytearray(input)
-        for i in range(len(input)):
-            ki = i & 0x7f
-            buf[i] = buf[i] ^ sz[ki]
+        self._xorinto(memoryview(buf))
         return buf
 
+    def _xorinto(self, view):
+        # work in key-aligned chunks so the temporaries stay a chunk long
+        # whatever the frame size; key integers are built once per length
+        n = len(view)
+        for i in range(0, n, _CHUNK):
+            size = min(_CHUNK, n - i)
+            key = _keyints.get(size)
+            if key is None:
+                key = _keyints[size] = int.from_bytes((_KEY * (_CHUNK // len(_KEY)))[:size], 'big')
+            chunk = view[i:i + size]
+            chunk[:] = (int.from_bytes(chunk, 'big') ^ key).to_bytes(size, 'big')
+
     def _create(self, path, mydict = {}):
         root = {}
         elem = root
-        try:
-            plist = path.strip('/').split('/')
-            k = len(plist) - 1
-            for i, j in enumerate(plist):
-                elem[j] = {}
-                if i == k:
-                    elem[j] = mydict
-                elem = elem.get(j)
-        except:
-            pass
+        plist = path.strip('/').split('/')
+        k = len(plist) - 1
+        for i, j in enumerate(plist):
+            elem[j] = {}
+            if i == k:
+                elem[j] = mydict
+            elem = elem.get(j)
         return root
 
     def _select(self, mydict, path):
@@ -670,94 +896,114 @@ class MeianClient():
                     elem = elem[i]
                 except ValueError:
                     elem = elem.get(i)
-        except:
-            pass
+        except (AttributeError, IndexError, KeyError, TypeError):
+            return None
         return elem
 
     def _xmlread(self, path, key, value):
-        try:
-            input = value
-            BOL = re.compile('BOL\|([FT])')
-            DTA = re.compile('DTA(,\d+)*\|(\d{4}\.\d{2}.\d{2}.\d{2}.\d{2}.\d{2})')
-            ERR = re.compile('ERR\|(\d{2})')
-            GBA = re.compile('GBA,(\d+)\|([0-9A-F]*)')
-            HMA = re.compile('HMA,(\d+)\|(\d{2}:\d{2})')
-            IPA = re.compile('IPA,(\d+)\|(([0-2]?\d{0,2}\.){3}([0-2]?\d{0,2}))')
-            MAC = re.compile('MAC,(\d+)\|(([0-9A-F]{2}[:-]){5}([0-9A-F]{2}))')
-            NEA = re.compile('NEA,(\d+)\|([0-9A-F]+)')
-            NUM = re.compile('NUM,(\d+),(\d+)\|(\d*)')
-            PWD = re.compile('PWD,(\d+)\|(.*)')
-            S32 = re.compile('S32,(\d+),(\d+)\|(\d*)')
-            STR = re.compile('STR,(\d+)\|(.*)')
-            TYP = re.compile('TYP,(\w+)\|(\d+)')
-            if BOL.match(input):
-                bol = BOL.search(input).groups()[0]
-                if bol == "T":
-                    value = True
-                if bol == "F":
-                    value = False
-            elif DTA.match(input):
-                dta = DTA.search(input).groups()[1]
-                value =  time.strptime(dta,'%Y.%m.%d.%H.%M.%S')
-            elif ERR.match(input):
-                value =  int(ERR.search(input).groups()[0])
-            elif GBA.match(input):
-                value =  bytearray.fromhex(GBA.search(input).groups()[1]).decode()
-            elif HMA.match(input):
-                hma = HMA.search(input).groups()[1]
-                value =  time.strptime(hma,'%H:%M')
-            elif IPA.match(input):
-                value =  str(IPA.search(input).groups()[1])
-            elif MAC.match(input):
-                value =  str(MAC.search(input).groups()[1])
-            elif NEA.match(input):
-                value =  str(NEA.search(input).groups()[1])
-            elif NUM.match(input):
-                value =  str(NUM.search(input).groups()[2])
-            elif PWD.match(input):
-                value =  str(PWD.search(input).groups()[1])
-            elif S32.match(input):
-                value =  int(S32.search(input).groups()[2])
-            elif STR.match(input):
-                value =  str(STR.search(input).groups()[1])
-            elif TYP.match(input):
-                value =  int(TYP.search(input).groups()[1])
-            else:
-                raise ResponseError('Unknown data type %s' % input)
+        if not isinstance(value, str):
             return key, value
-        except (ValueError, TypeError):
+        entry = _types.get(value[:3])
+        match = entry and entry[0].match(value)
+        if not match:
+            raise ResponseError('Unknown data type %s' % value)
+        try:
+            return key, entry[2](match.group(entry[1]))
+        except ValueError:
             return key, value
 
 
-class MeianPushClient(asyncore.dispatcher, threading.Thread, MeianClient):
+class MeianPushClient(threading.Thread, MeianClient):
 
     daemon = True
     keepalive = 60
+    deadpeer = None
     timeout = 10
-
-    def __init__(self, host, port, uid, handler):
+    socket = None
+    connected = False
+    subscribed = False
+    dead = False
+    maxbuffer = 65536
+    highwater = 16384
+    maxtimers = 64
+    live = weakref.WeakSet()
+
+    def __init__(self, host, port, uid, handler, capture = None, keepalive = None, deadpeer = None):
         if not callable(handler):
             raise AttributeError('handler is not a function')
+        if capture is not None:
+            self.capture = capture
+        if keepalive is not None:
+            self.keepalive = keepalive
+        self.deadpeer = deadpeer or self.deadpeer or self.timeout
         self.host = host
         self.port = port
         self.handler = handler
+        self.frames = 0
+        self.alarms = 0
+        self._fill = 0
+        self._timers = []
+        self._count = 0
+        self._cancelled = 0
+        self._ping = None
+        self._pong = None
+        self._closing = False
         cmd = OD()
         cmd['Id'] = STR(uid)
         cmd['Err'] = None
         xpath = '/Root/Pair/Push'
         self.mesg = self._create(xpath, cmd)
         threading.Thread.__init__(self)
-        self._thread_sockets = dict()
-        asyncore.dispatcher.__init__(self, map=self._thread_sockets)
+        self.live.add(self)
         self.start()
 
-    def __del__(self):
-        try:
-            self.close()
-        except AttributeError:
-            pass
-        else:
-            self.close()
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self, timeout = None):
+        self._closing = True
+        self.connected = False
+        if threading.current_thread() is not self and self.is_alive():
+            # wake the loop with EOF and let it release everything itself
+            sock = self.socket
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            self.join(timeout)
+        sock, self.socket = self.socket, None
+        if sock is not None:
+            sock.close()
+
+    def resources(self):
+        res = OD()
+        res['Sockets'] = 0 if self.socket is None else 1
+        res['Timers'] = len(self._timers) - self._cancelled
+        res['Buffer'] = 0 if self._buf is None else len(self._buf)
+        res['Pending'] = self._fill
+        res['Frames'] = self.frames
+        res['Alarms'] = self.alarms
+        return res
+
+    @classmethod
+    def accounting(cls):
+        total = OD([('Clients', 0), ('Threads', 0), ('Sockets', 0), ('Timers', 0), ('Buffer', 0), ('Pending', 0), ('Frames', 0), ('Alarms', 0)])
+        for client in list(cls.live):
+            total['Clients'] += 1
+            total['Threads'] += 1 if client.is_alive() else 0
+            for key, value in client.resources().items():
+                total[key] += value
+        return total
+
+    def send(self, data):
+        if self.socket is None:
+            return 0
+        self.socket.sendall(data)
+        return len(data)
 
     def readable(self):
         return True
@@ -767,40 +1013,81 @@ class MeianPushClient(asyncore.dispatcher, threading.Thread, MeianClient):
             return True
         return False
 
+    def call_later(self, delay, callback):
+        if len(self._timers) - self._cancelled >= self.maxtimers:
+            raise PushClientError("Timer limit exceeded")
+        self._count += 1
+        timer = [time.time() + delay, self._count, callback]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def cancel_timer(self, timer):
+        if timer is not None and timer[2] is not None:
+            timer[2] = None
+            self._cancelled += 1
+            # cancelled keepalives are far in the future, drop them early
+            if self._cancelled > self.maxtimers:
+                self._timers = [t for t in self._timers if t[2] is not None]
+                heapq.heapify(self._timers)
+                self._cancelled = 0
+
     def handle_connect(self):
-        threading.Timer(self.keepalive, self._keepalive).start()
-        pass
+        self._ping = self.call_later(self.keepalive, self._keepalive)
 
     def handle_error(self):
         self.close()
         raise
 
     def handle_read(self):
-        data = self.recv(1024)
-        if (type(data) == str):
-            data = data.encode()
-        head = data[0:4]
+        self._reserve(self._fill + self.minread, self._fill)
+        if len(self._buf) > self.maxbuffer:
+            raise PushClientError("Buffer limit exceeded")
+        try:
+            n = self.socket.recv_into(self._view[self._fill:])
+        except BlockingIOError:
+            return
+        except socket.error:
+            self.handle_close()
+            return
+        if n == 0:
+            self.handle_close()
+            return
+        self._fill += n
+        start = 0
+        frame = self._frame(start)
+        while frame is not None:
+            start += len(frame)
+            self._dispatch(frame)
+            frame = self._frame(start)
+        if start:
+            self._consume(start)
+        if self._fill == 0 and len(self._buf) > self.highwater:
+            self._buf = self._view = None
+
+    def _dispatch(self, frame):
+        head = frame[0:4].tobytes()
+        self.frames += 1
+        self._record(MeianCapture.IN, frame)
 
         if head == b'%maI':
-            threading.Timer(self.keepalive, self._keepalive).start()
+            self.cancel_timer(self._pong)
+            self.cancel_timer(self._ping)
+            self._pong = None
+            self._ping = self.call_later(self.keepalive, self._keepalive)
 
         elif head == b'@ieM':
             xpath = '/Root/Pair/Push'
-            resp = xmltodict.parse(self._xor(data[16:-4]).decode(), xml_attribs=False, dict_constructor=dict, postprocessor=self._xmlread)
-            self.push = self._select(resp, xpath)
+            resp = self._decode(frame)
             err = self._select(resp, '%s/Err' % xpath)
             if err:
                 self.close()
                 raise PushClientError("Push subscription error")
+            self.subscribed = True
 
-        elif head == b'@alA':
-            xpath = '/Root/Host/Alarm'
-            resp = xmltodict.parse(self._xor(data[16:-4]).decode(), xml_attribs=False, dict_constructor=dict, postprocessor=self._xmlread)
-            self.handler(self._select(resp, xpath))
-
-        elif head == b'!lmX':
+        elif head == b'@alA' or head == b'!lmX':
             xpath = '/Root/Host/Alarm'
-            resp = xmltodict.parse(data[16:-4], xml_attribs=False, dict_constructor=dict, postprocessor=self._xmlread)
+            resp = self._decode(frame)
+            self.alarms += 1
             self.handler(self._select(resp, xpath))
 
         else:
@@ -809,8 +1096,8 @@ class MeianPushClient(asyncore.dispatcher, threading.Thread, MeianClient):
 
     def handle_write(self):
         if self.mesg is not None:
-            xml = dicttoxml.dicttoxml(self.mesg, attr_type=False, root=False)
-            mesg = b'@ieM%04d%04d0000%s%04d' % (len(xml), 0, self._xor(xml), 0)
+            mesg = self._encode(self.mesg, 0)
+            self._record(MeianCapture.OUT, mesg)
             self.send(mesg)
             self.mesg = None
 
@@ -819,21 +1106,1380 @@ class MeianPushClient(asyncore.dispatcher, threading.Thread, MeianClient):
 
     def _keepalive(self):
         mesg = b'%maI'
+        self._record(MeianCapture.OUT, mesg)
         self.send(mesg)
-        self.mesg = None
+        self._ping = None
+        if self._pong is None:
+            self._pong = self.call_later(self.deadpeer, self._deadpeer)
+
+    def _deadpeer(self):
+        self._pong = None
+        self.dead = True
+        self.close()
+
+    def _runtimers(self):
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            callback = heapq.heappop(self._timers)[2]
+            if callback is not None:
+                callback()
+            else:
+                self._cancelled -= 1
+        while self._timers and self._timers[0][2] is None:
+            heapq.heappop(self._timers)
+            self._cancelled -= 1
+        if self._timers:
+            return max(0, min(self.timeout, self._timers[0][0] - time.time()))
+        return self.timeout
 
     def run(self):
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            self.connect((self.host, self.port))
+            self.socket = socket.create_connection((self.host, self.port), self.timeout)
         except socket.timeout:
             self.close()
             raise ConnectionError("Connection error")
+        if self._closing:
+            self.close()
+            return
+        self.connected = True
+        self.handle_connect()
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
         try:
-            asyncore.loop(timeout=self.timeout, map = self._thread_sockets)
+            while self.socket is not None and not self._closing:
+                wait = self._runtimers()
+                if self.socket is None:
+                    break
+                mask = selectors.EVENT_READ
+                if self.writable():
+                    mask |= selectors.EVENT_WRITE
+                selector.modify(self.socket, mask)
+                for key, events in selector.select(wait):
+                    try:
+                        if events & selectors.EVENT_READ and self.socket is not None:
+                            self.handle_read()
+                        if events & selectors.EVENT_WRITE and self.socket is not None:
+                            self.handle_write()
+                    except socket.error:
+                        raise
+                    except Exception:
+                        self.handle_error()
         except socket.error:
             self.close()
             raise ConnectionError("Connection error")
+        finally:
+            selector.close()
+            self.close()
+            del self._timers[:]
+            self._cancelled = 0
+            self._ping = self._pong = None
+            self._buf = self._view = None
+            self._fill = 0
+        if self.dead:
+            raise ConnectionError("Keepalive timeout")
+
+class MeianCapture():
+
+    OUT = 0
+    IN = 1
+    magic = b'MEIANCAP\x01'
+    record = struct.Struct('<dBI')
+    secrets = ('Id', 'Token')
+    markers = (b'PWD,', b'<Id>STR,', b'<Token>STR,')
+
+    def __init__(self, path, mode = 'wb'):
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        # captures hold panel traffic, keep them private to the owner
+        self.file = open(path, mode, opener=lambda path, flags: os.open(path, flags, 0o600))
+        if 'r' in mode:
+            if self.file.read(len(self.magic)) != self.magic:
+                self.file.close()
+                raise ResponseError('Not a capture file %s' % path)
+        elif self.file.tell() == 0:
+            self.file.write(self.magic)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            head = self.file.read(self.record.size)
+            if len(head) < self.record.size:
+                return
+            ts, direction, size = self.record.unpack(head)
+            yield ts, direction, self.file.read(size)
+
+    @classmethod
+    def redact(cls, root, key = None):
+        # the frame XOR uses a fixed public key, so every password and
+        # text Id or Token would be stored in recoverable form
+        if isinstance(root, dict):
+            return OD((k, cls.redact(v, k)) for k, v in root.items())
+        if isinstance(root, list):
+            return [cls.redact(v, key) for v in root]
+        if isinstance(root, str):
+            kind = root.split('|', 1)[0].split(',', 1)[0]
+            if kind == 'PWD' or (key in cls.secrets and kind in ('STR', 'PWD')):
+                return '%s,0|' % kind
+        return root
+
+    def write(self, direction, frame):
+        with self.lock:
+            self.file.write(self.record.pack(time.time(), direction, len(frame)))
+            self.file.write(frame)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class MeianReplay(MeianClient):
+
+    def __init__(self, path, handler = None, speed = None):
+        if handler is not None and not callable(handler):
+            raise AttributeError('handler is not a function')
+        self.path = path
+        self.handler = handler
+        self.speed = speed
+        self.frames = 0
+        self.alarms = 0
+        self.bytes = 0
+
+    def run(self):
+        start = first = None
+        with MeianCapture(self.path, 'rb') as capture:
+            for ts, direction, data in capture:
+                if self.speed:
+                    if start is None:
+                        start, first = time.time(), ts
+                    wait = start + (ts - first) / self.speed - time.time()
+                    if wait > 0:
+                        time.sleep(wait)
+                if direction != MeianCapture.IN:
+                    continue
+                self._reserve(self._fill + len(data), self._fill)
+                self._view[self._fill:self._fill + len(data)] = data
+                self._fill += len(data)
+                self.bytes += len(data)
+                frame = self._frame(0)
+                while frame is not None:
+                    size = len(frame)
+                    if frame[0:4] != b'%maI':
+                        resp = self._decode(frame)
+                        if frame[0:4] in (b'@alA', b'!lmX'):
+                            self.alarms += 1
+                            if self.handler is not None:
+                                self.handler(self._select(resp, '/Root/Host/Alarm'))
+                    self.frames += 1
+                    self._consume(size)
+                    frame = self._frame(0)
+        return self.frames
+
+class MeianScheduler():
+
+    rate = 2.0
+    burst = 2
+    group_rate = 5.0
+    group_burst = 5
+    slow = 2.0
+    floor = 0.1
+    interactive = ['SetAlarmStatus', 'OpSwitch']
+
+    def __init__(self, rate = None, group_rate = None):
+        if rate is not None:
+            self.rate = rate
+        if group_rate is not None:
+            self.group_rate = group_rate
+        self.buckets = dict()
+        self._waiting = []
+        self._count = 0
+        self._cond = threading.Condition()
+
+    def attach(self, client, panel, group = None):
+        client.scheduler = self
+        client.panel = panel
+        client.group = group
+        return client
+
+    def priority(self, command):
+        if command in self.interactive:
+            return 0
+        if command.startswith('Get'):
+            return 2
+        return 1
+
+    def acquire(self, client, command, timeout = None, token = None):
+        keys = self._keys(client)
+        prio = self.priority(command)
+        end = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self._count += 1
+            entry = (prio, self._count, keys)
+            self._waiting.append(entry)
+            self._waiting.sort()
+            try:
+                while True:
+                    wait = self._take(entry)
+                    if wait is None:
+                        return
+                    if token is not None:
+                        if token.is_set():
+                            raise CancelledError("Command cancelled")
+                        wait = min(wait, client.tick)
+                    if end is not None:
+                        if end <= time.time():
+                            raise DeadlineError("Command deadline exceeded")
+                        wait = min(wait, end - time.time())
+                    self._cond.wait(wait)
+            finally:
+                self._waiting.remove(entry)
+                self._cond.notify_all()
+
+    def release(self, client, latency, error = False):
+        with self._cond:
+            for key in self._keys(client):
+                bucket = self._bucket(key)
+                bucket['busy'] = max(0, bucket['busy'] - 1)
+                bucket['latency'] = latency
+                if error or latency > self.slow:
+                    bucket['factor'] = max(self.floor, bucket['factor'] / 2)
+                else:
+                    bucket['factor'] = min(1.0, bucket['factor'] + 0.1)
+            self._cond.notify_all()
+
+    def _keys(self, client):
+        keys = [('panel', client.panel if client.panel is not None else id(client))]
+        if client.group is not None:
+            keys.append(('group', client.group))
+        return keys
+
+    def _bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if key[0] == 'group':
+                rate, burst = self.group_rate, self.group_burst
+            else:
+                rate, burst = self.rate, self.burst
+            bucket = self.buckets[key] = dict(tokens=burst, last=time.time(), rate=rate, burst=burst, factor=1.0, busy=0, latency=None)
+        return bucket
+
+    def _take(self, entry):
+        prio, n, keys = entry
+        for other in self._waiting:
+            if other is entry:
+                break
+            if any(key in other[2] for key in keys):
+                return self.slow
+        now = time.time()
+        wait = None
+        buckets = [self._bucket(key) for key in keys]
+        for bucket in buckets:
+            rate = bucket['rate'] * bucket['factor']
+            bucket['tokens'] = min(bucket['burst'], bucket['tokens'] + (now - bucket['last']) * rate)
+            bucket['last'] = now
+            if bucket['busy'] and bucket is buckets[0]:
+                wait = self.slow
+            elif bucket['tokens'] < 1 and not (prio == 0 and bucket['tokens'] > -bucket['burst']):
+                wait = max(wait or 0, (1 - bucket['tokens']) / rate)
+        if wait is not None:
+            return wait
+        for bucket in buckets:
+            bucket['tokens'] -= 1
+            bucket['busy'] += 1
+        return None
+
+class MeianStore():
+
+    commands = ['GetZone', 'GetSensor', 'GetRemote', 'GetRfid', 'GetSwitchInfo', 'GetSys']
+    maxage = 3600
+    spread = 30
+
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        if path not in ('', ':memory:'):
+            os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS state (panel TEXT, command TEXT, updated REAL, data BLOB, PRIMARY KEY (panel, command))')
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._state = dict()
+        self._refreshing = set()
+        for panel, command, updated, data in self.db.execute('SELECT panel, command, updated, data FROM state'):
+            # rows written by older versions hold pickles; never load them,
+            # the next refresh overwrites them
+            if not isinstance(data, str):
+                continue
+            self._state[(panel, command)] = [updated, data, False]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def panels(self):
+        return sorted(set(k[0] for k in self._state))
+
+    def age(self, panel, command):
+        entry = self._state.get((panel, command))
+        if entry is None:
+            return None
+        return time.time() - entry[0]
+
+    def get(self, panel, command, default = None):
+        import json
+        with self._lock:
+            entry = self._state.get((panel, command))
+            if entry is None:
+                return default
+            if not entry[2]:
+                entry[1] = json.loads(entry[1], object_pairs_hook=self._unpack)
+                entry[2] = True
+            return entry[1]
+
+    def put(self, panel, command, data, updated = None):
+        import json
+        if updated is None:
+            updated = time.time()
+        text = json.dumps(self._pack(data))
+        with self._lock:
+            self._state[(panel, command)] = [updated, data, True]
+            self.db.execute('INSERT OR REPLACE INTO state (panel, command, updated, data) VALUES (?, ?, ?, ?)', (panel, command, updated, text))
+
+    def _pack(self, value):
+        # struct_time is a tuple and would come back as a plain list
+        if isinstance(value, time.struct_time):
+            return {'__time__': tuple(value)}
+        if isinstance(value, dict):
+            return OD((k, self._pack(v)) for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return [self._pack(v) for v in value]
+        return value
+
+    def _unpack(self, pairs):
+        if len(pairs) == 1 and pairs[0][0] == '__time__':
+            return time.struct_time(pairs[0][1])
+        return OD(pairs)
+
+    def fetch(self, client, panel, command, maxage = None):
+        if maxage is None:
+            maxage = self.maxage
+        age = self.age(panel, command)
+        if age is None:
+            data = getattr(client, command)()
+            self.put(panel, command, data)
+            return data
+        if age > maxage:
+            self.revalidate(client, panel, [command])
+        return self.get(panel, command)
+
+    def warm(self, client, panel, commands = None, maxage = None):
+        if commands is None:
+            commands = self.commands
+        if maxage is None:
+            maxage = self.maxage
+        state = OD()
+        stale = []
+        for command in commands:
+            age = self.age(panel, command)
+            if age is None or age > maxage:
+                stale.append(command)
+            state[command] = self.get(panel, command)
+        if stale:
+            self.revalidate(client, panel, stale, random.uniform(0, self.spread))
+        return state
+
+    def revalidate(self, client, panel, commands, delay = 0):
+        with self._lock:
+            commands = [c for c in commands if (panel, c) not in self._refreshing]
+            self._refreshing.update((panel, c) for c in commands)
+        if not commands:
+            return None
+        worker = threading.Thread(target=self._revalidate, args=(client, panel, commands, delay))
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def _revalidate(self, client, panel, commands, delay):
+        if delay:
+            time.sleep(delay)
+        for command in commands:
+            try:
+                self.put(panel, command, getattr(client, command)())
+            except Exception:
+                self.errors += 1
+            finally:
+                with self._lock:
+                    self._refreshing.discard((panel, command))
+
+class MeianEnrolment():
+
+    interval = 1
+    max_interval = 8
+    duration = 60
+    workers = 8
+
+    def __init__(self, client, fsk = True):
+        self.client = client
+        self.fsk = fsk
+        self.devices = OD()
+        self.known = set()
+        self.occupied = set()
+        self.studying = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        for num, item in enumerate(self.client.GetWlsList()):
+            if isinstance(item, dict) and item.get('Code'):
+                self.known.add(item['Code'])
+                self.occupied.add(num)
+        if self.fsk:
+            self.client.FskStudy(True)
+        else:
+            self.client.WlsStudy()
+        self.studying = True
+
+    def stop(self):
+        if self.studying and self.fsk:
+            self.client.FskStudy(False)
+        self.studying = False
+
+    def poll(self):
+        new = []
+        for item in self.client.GetWlsList():
+            if not isinstance(item, dict):
+                continue
+            code = item.get('Code')
+            if not code or code in self.known or code in self.devices:
+                continue
+            self.devices[code] = item
+            new.append(item)
+        return new
+
+    def run(self, duration = None, expect = None, handler = None):
+        if duration is None:
+            duration = self.duration
+        end = time.time() + duration
+        interval = self.interval
+        with self:
+            while time.time() < end:
+                new = self.poll()
+                for item in new:
+                    if handler is not None:
+                        handler(item)
+                if expect is not None and len(self.devices) >= expect:
+                    break
+                if new:
+                    interval = self.interval
+                else:
+                    interval = min(self.max_interval, interval * 2)
+                time.sleep(max(0, min(interval, end - time.time())))
+        return list(self.devices.values())
+
+    def save(self, slots = None, devices = None):
+        if devices is None:
+            devices = list(self.devices.values())
+        # never write over a device that was enrolled before this session
+        occupied = set(self.occupied)
+        for num, item in enumerate(self.client.GetWlsList()):
+            if isinstance(item, dict) and item.get('Code') in self.known:
+                occupied.add(num)
+        if slots is None:
+            slots = []
+            num = 0
+            while len(slots) < len(devices):
+                if num not in occupied:
+                    slots.append(num)
+                num += 1
+        slots = list(slots)
+        if len(slots) < len(devices):
+            raise AttributeError('%d slots for %d devices' % (len(slots), len(devices)))
+        for num in slots:
+            if num in occupied:
+                raise AttributeError('slot %d is occupied' % num)
+        result = []
+        for num, item in zip(slots, devices):
+            result.append(self.client.WlsSave(item.get('Type') or 0, num, item['Code']))
+        return result
+
+    @classmethod
+    def fleet(cls, clients, duration = None, expect = None, save = False, workers = None):
+        results = dict()
+        slots = threading.Semaphore(workers or cls.workers)
+
+        def enrol(name, client):
+            with slots:
+                try:
+                    session = cls(client)
+                    session.run(duration, expect)
+                    if save:
+                        session.save()
+                    results[name] = list(session.devices.values())
+                except Exception as e:
+                    results[name] = e
+
+        threads = [threading.Thread(target=enrol, args=item) for item in clients.items()]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+class MeianEnricher():
+
+    base = 0
+    commands = OD([('Zone', 'GetZone'), ('Sensor', 'GetSensor'), ('Remote', 'GetRemote')])
+    users = ['1401', '3401', '3441']
+
+    def __init__(self, store = None):
+        self.store = store
+        self.index = dict()
+        self.sources = dict()
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+    def add(self, panel, client, wait = True):
+        self.sources[panel] = client
+        if wait:
+            self.refresh(panel, False)
+        else:
+            self._background(panel, False)
+
+    def remove(self, panel):
+        self.sources.pop(panel, None)
+        self.index.pop(panel, None)
+
+    def refresh(self, panel, fresh = True):
+        client = self.sources[panel]
+        index = dict()
+        for kind, command in self.commands.items():
+            if self.store is not None and not fresh:
+                items = self.store.fetch(client, panel, command)
+            else:
+                items = getattr(client, command)()
+                if self.store is not None:
+                    self.store.put(panel, command, items)
+            names = dict()
+            for i, item in enumerate(items or []):
+                if isinstance(item, dict):
+                    name = item.get('Name') or item.get('Code')
+                    if name:
+                        names[i + self.base] = name
+            index[kind] = names
+        self.index[panel] = index
+        return index
+
+    def name(self, panel, kind, num):
+        return self.index.get(panel, {}).get(kind, {}).get(num)
+
+    def enrich(self, panel, alarm):
+        if not isinstance(alarm, dict):
+            return alarm
+        ev = OD(alarm)
+        cid = str(alarm.get('Cid'))
+        zone = alarm.get('Zone')
+        ev['Description'] = Cid.get(cid)
+        ev['Severity'] = Severity.get(cid) or _severity(cid)
+        index = self.index.get(panel, {})
+        if cid in self.users:
+            ev['RemoteName'] = index.get('Remote', {}).get(zone)
+        else:
+            ev['ZoneName'] = index.get('Zone', {}).get(zone)
+            ev['SensorName'] = index.get('Sensor', {}).get(zone)
+        if cid == '1306' and panel in self.sources:
+            self._background(panel)
+        return ev
+
+    def handler(self, panel, handler):
+        def enriched(alarm):
+            handler(self.enrich(panel, alarm))
+        return enriched
+
+    def _background(self, panel, fresh = True):
+        with self._lock:
+            if panel in self._refreshing:
+                return
+            self._refreshing.add(panel)
+        worker = threading.Thread(target=self._refresh, args=(panel, fresh))
+        worker.daemon = True
+        worker.start()
+
+    def _refresh(self, panel, fresh):
+        try:
+            self.refresh(panel, fresh)
+        except Exception:
+            self.errors += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard(panel)
+
+class MeianPoller(threading.Thread):
+
+    daemon = True
+    interval = 5
+    min_interval = 1
+    max_interval = 60
+    rate = 10
+    workers = 4
+    commands = ['GetAlarmStatus', 'GetByWay', 'GetSwitch']
+
+    def __init__(self, handler = None, rate = None, workers = None):
+        if handler is not None and not callable(handler):
+            raise AttributeError('handler is not a function')
+        self.handler = handler
+        self.events = queue.Queue()
+        if rate is not None:
+            self.rate = rate
+        if workers is not None:
+            self.workers = workers
+        self.panels = dict()
+        self.failed = 0
+        self.failure = None
+        self._due = []
+        self._count = 0
+        self._last = 0
+        self._work = queue.Queue()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._halt = threading.Event()
+        threading.Thread.__init__(self)
+
+    def __iter__(self):
+        while not self._halt.is_set() or not self.events.empty():
+            try:
+                yield self.events.get(timeout=self.min_interval)
+            except queue.Empty:
+                pass
+
+    def add(self, name, client, commands = None, interval = None, factory = None):
+        if factory is not None and not callable(factory):
+            raise AttributeError('factory is not a function')
+        if commands is None:
+            commands = self.commands
+        state = dict()
+        state['client'] = client
+        state['factory'] = factory
+        state['commands'] = list(commands)
+        state['snapshot'] = dict()
+        state['interval'] = interval or self.interval
+        state['error'] = None
+        with self._lock:
+            self.panels[name] = state
+            self._schedule(time.time(), name, state)
+        self._wake.set()
+
+    def remove(self, name):
+        with self._lock:
+            self.panels.pop(name, None)
+
+    def snapshot(self, name):
+        return dict(self.panels[name]['snapshot'])
+
+    def stop(self):
+        self._halt.set()
+        self._wake.set()
+
+    def _schedule(self, due, name, state):
+        # entries carry their state so a removed or re-added panel's old
+        # entry is recognised and dropped
+        self._count += 1
+        heapq.heappush(self._due, (due, self._count, name, state))
+
+    def run(self):
+        workers = [threading.Thread(target=self._worker) for i in range(self.workers)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        while not self._halt.is_set():
+            with self._lock:
+                while self._due and self.panels.get(self._due[0][2]) is not self._due[0][3]:
+                    heapq.heappop(self._due)
+                if self._due:
+                    due = self._due[0][0]
+                else:
+                    due = time.time() + self.max_interval
+                due = max(due, self._last + 1.0 / self.rate)
+            wait = due - time.time()
+            if wait > 0:
+                self._wake.wait(wait)
+                self._wake.clear()
+                continue
+            with self._lock:
+                if not self._due:
+                    continue
+                due, count, name, state = heapq.heappop(self._due)
+            self._last = time.time()
+            self._work.put((name, state))
+        for worker in workers:
+            self._work.put(None)
+
+    def _worker(self):
+        while True:
+            item = self._work.get()
+            if item is None:
+                return
+            name, state = item
+            changes = self._poll(name, state)
+            if changes:
+                state['interval'] = max(self.min_interval, state['interval'] / 2)
+            elif state['error'] is not None:
+                state['interval'] = min(self.max_interval, state['interval'] * 2)
+            else:
+                state['interval'] = min(self.max_interval, state['interval'] * 1.5)
+            with self._lock:
+                if self.panels.get(name) is state:
+                    self._schedule(time.time() + state['interval'], name, state)
+            self._wake.set()
+
+    def _connect(self, state):
+        if state['client'] is None and state['factory'] is not None:
+            try:
+                state['client'] = state['factory']()
+            except Exception as e:
+                state['error'] = e
+        return state['client']
+
+    def _poll(self, name, state):
+        changes = 0
+        state['error'] = None
+        client = self._connect(state)
+        if client is None:
+            return changes
+        for command in state['commands']:
+            if isinstance(command, (tuple, list)):
+                command, args = command[0], tuple(command[1:])
+            else:
+                args = ()
+            label = '/'.join([command] + [str(a) for a in args])
+            try:
+                resp = getattr(client, command)(*args)
+            except (ConnectionError, socket.error) as e:
+                # the session is gone, reconnect on the next round
+                state['error'] = e
+                if state['factory'] is not None:
+                    state['client'] = None
+                    client.close()
+                break
+            except Exception as e:
+                state['error'] = e
+                continue
+            new = self._flatten(resp)
+            old = state['snapshot'].get(label)
+            state['snapshot'][label] = new
+            if old is None:
+                continue
+            for key in sorted(set(old) | set(new)):
+                if old.get(key) != new.get(key):
+                    delta = OD()
+                    delta['Panel'] = name
+                    delta['Command'] = label
+                    delta['Key'] = key
+                    delta['Old'] = old.get(key)
+                    delta['New'] = new.get(key)
+                    self._emit(delta)
+                    changes += 1
+        return changes
+
+    def _emit(self, delta):
+        if self.handler is None:
+            self.events.put(delta)
+            return
+        try:
+            self.handler(delta)
+        except Exception as e:
+            self.failed += 1
+            self.failure = e
+
+    def _flatten(self, resp):
+        flat = dict()
+        if isinstance(resp, list):
+            for i, item in enumerate(resp):
+                for key, value in self._flatten(item).items():
+                    flat['L%d/%s' % (i, key)] = value
+        elif isinstance(resp, dict):
+            for key, value in resp.items():
+                if key not in ('Err', 'Total', 'Offset', 'Ln'):
+                    flat[key] = value
+        return flat
+
+class MeianEventStream(threading.Thread):
+
+    daemon = True
+    window = 4096
+    skew = 5
+    delay = 1
+    interval = 30
+    backlog = 65536
+    block = 1
+    enricher = None
+
+    def __init__(self, handler = None, enricher = None):
+        if enricher is not None:
+            self.enricher = enricher
+        self.subscribers = []
+        self.sources = dict()
+        self.duplicates = 0
+        self.failed = 0
+        self.failure = None
+        self.dropped = 0
+        self._overflow = OD()
+        self._index = dict()
+        self._pending = []
+        self._count = 0
+        self._cond = threading.Condition()
+        self._halt = threading.Event()
+        if handler is not None:
+            self.subscribe(handler)
+        threading.Thread.__init__(self)
+
+    def subscribe(self, handler, panel = None):
+        if not callable(handler):
+            raise AttributeError('handler is not a function')
+        with self._cond:
+            self.subscribers.append((handler, panel))
+
+    def unsubscribe(self, handler):
+        with self._cond:
+            self.subscribers = [s for s in self.subscribers if s[0] != handler]
+
+    def pusher(self, panel):
+        def handler(alarm):
+            self.put(panel, alarm, 'push')
+        return handler
+
+    def add(self, panel, client):
+        with self._cond:
+            self.sources[panel] = client
+
+    def remove(self, panel):
+        with self._cond:
+            self.sources.pop(panel, None)
+            self._index.pop(panel, None)
+
+    def put(self, panel, event, source = 'push', deliver = True):
+        if not isinstance(event, dict):
+            return False
+        ts = event.get('Time')
+        if isinstance(ts, time.struct_time):
+            ts = time.mktime(ts)
+        elif not isinstance(ts, (int, float)):
+            ts = time.time()
+        cid = str(event.get('Cid'))
+        zone = str(event.get('Zone'))
+        bucket = int(ts // self.skew)
+        with self._cond:
+            index = self._index.setdefault(panel, OD())
+            for b in (bucket - 1, bucket, bucket + 1):
+                if (cid, zone, b) in index:
+                    self.duplicates += 1
+                    return False
+            index[(cid, zone, bucket)] = None
+            if len(index) > self.window:
+                index.popitem(last=False)
+            if not deliver:
+                return True
+            # hold the producer while subscribers catch up; if they do not,
+            # refuse this event rather than lose one already queued, and
+            # forget it so the next log poll can offer it again
+            end = time.time() + self.block
+            while len(self._pending) >= self.backlog and time.time() < end and not self._halt.is_set():
+                self._cond.wait(end - time.time())
+            if len(self._pending) >= self.backlog:
+                index.pop((cid, zone, bucket), None)
+                self.dropped += 1
+                self._overflow[panel] = self._overflow.get(panel, 0) + 1
+                self._cond.notify_all()
+                return False
+            ev = OD()
+            ev['Panel'] = panel
+            ev['Source'] = source
+            if self.enricher is not None:
+                event = self.enricher.enrich(panel, event)
+            ev.update(event)
+            self._count += 1
+            heapq.heappush(self._pending, (ts, self._count, time.time(), ev))
+            self._cond.notify_all()
+        return True
+
+    def stop(self):
+        self._halt.set()
+        with self._cond:
+            self._cond.notify()
+
+    def run(self):
+        poller = threading.Thread(target=self._poll)
+        poller.daemon = True
+        poller.start()
+        while not self._halt.is_set():
+            with self._cond:
+                ready = []
+                for panel, count in self._overflow.items():
+                    ev = OD()
+                    ev['Panel'] = panel
+                    ev['Source'] = 'overflow'
+                    ev['Dropped'] = count
+                    ready.append(ev)
+                self._overflow.clear()
+                now = time.time()
+                while self._pending and self._pending[0][2] + self.delay <= now:
+                    ready.append(heapq.heappop(self._pending)[3])
+                if not ready:
+                    if self._pending:
+                        self._cond.wait(self._pending[0][2] + self.delay - now)
+                    else:
+                        self._cond.wait()
+                    continue
+                self._cond.notify_all()
+                subscribers = list(self.subscribers)
+            for ev in ready:
+                for handler, panel in subscribers:
+                    if panel is None or panel == ev['Panel']:
+                        try:
+                            handler(ev)
+                        except Exception as e:
+                            self.failed += 1
+                            self.failure = e
+
+    def _poll(self):
+        seeded = set()
+        totals = dict()
+        while not self._halt.is_set():
+            with self._cond:
+                sources = list(self.sources.items())
+            for panel, client in sources:
+                try:
+                    totals[panel] = self._fetch(panel, client, panel in seeded, totals.get(panel, 0))
+                except Exception:
+                    continue
+                seeded.add(panel)
+            self._halt.wait(self.interval)
+
+    def _fetch(self, panel, client, seeded, last):
+        # page through the log only until a page holds nothing new; if the
+        # first page was all known, new entries were appended at the tail,
+        # past the old Total if the log grew or in the last page if it is
+        # full and rotating, so skip straight to them once
+        cmd = OD()
+        cmd['Total'] = None
+        cmd['Offset'] = S32(0)
+        cmd['Ln'] = None
+        cmd['Err'] = None
+        xpath = '/Root/Host/GetEvents'
+        offset = found = 0
+        tail = False
+        while True:
+            total, page = client._page(xpath, cmd, offset)
+            fresh = 0
+            for event in page:
+                if self.put(panel, event, 'poll', seeded):
+                    fresh += 1
+            found += fresh
+            offset += len(page)
+            if not page or offset >= total:
+                return total
+            if seeded and not fresh:
+                if found or tail:
+                    return total
+                tail = True
+                offset = max(offset, last if total > last else total - len(page))
+
+class MeianGateway():
+
+    ttl = 2
+    timeout = 10
+    maxcache = 1024
+    # read-only commands that carry no credentials; device listings
+    # (GetRfid, GetRemote, GetSensor, GetWlsList) return enrolled codes
+    # and, like writes such as SetAlarmStatus, must be exposed explicitly
+    commands = ['GetAlarmStatus', 'GetByWay', 'GetDefense', 'GetEvents', 'GetLog', 'GetNet', 'GetOverlapZone', 'GetPhone', 'GetRfidType', 'GetSendby', 'GetSwitch', 'GetSwitchInfo', 'GetSys', 'GetTime', 'GetVoiceType', 'GetWlsStatus', 'GetZone', 'GetZoneType']
+
+    def __init__(self, panels, token, address = ('127.0.0.1', 8080), commands = None):
+        if not token:
+            raise AttributeError('token is not set')
+        if commands is not None:
+            self.commands = list(commands)
+        for command in self.commands:
+            if not command[:1].isupper() or not callable(getattr(MeianClient, command, None)):
+                raise AttributeError('unknown command %s' % command)
+        self.token = token
+        self.panels = dict(panels)
+        self.sessions = dict()
+        self.cache = OD()
+        import http.server
+        self.stats = dict(requests=0, hits=0, coalesced=0, calls=0, errors=0)
+        self._inflight = dict()
+        self._queues = dict()
+        self._lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer(address, self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+        self._serving = False
+
+    def start(self):
+        self._serving = True
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def serve_forever(self):
+        self._serving = True
+        self.server.serve_forever()
+
+    def shutdown(self):
+        if self._serving:
+            self.server.shutdown()
+        self.server.server_close()
+        with self._lock:
+            for q in self._queues.values():
+                q.put(None)
+
+    def call(self, panel, command, *args, **kwargs):
+        if panel not in self.panels:
+            raise KeyError(panel)
+        if command not in self.commands:
+            raise AttributeError(command)
+        key = (panel, command, args, tuple(sorted(kwargs.items())))
+        read = command.startswith('Get')
+        with self._lock:
+            self.stats['requests'] += 1
+            if read:
+                hit = self.cache.get(key)
+                if hit is not None and time.time() - hit[0] < self.ttl:
+                    self.stats['hits'] += 1
+                    return hit[1]
+                flight = self._inflight.get(key)
+                if flight is not None:
+                    self.stats['coalesced'] += 1
+            else:
+                flight = None
+            if flight is None:
+                flight = dict(done=threading.Event(), result=None, error=None)
+                if read:
+                    self._inflight[key] = flight
+                self._queue(panel).put((key, read, flight))
+        flight['done'].wait()
+        if flight['error'] is not None:
+            raise flight['error']
+        return flight['result']
+
+    def _store(self, key, result):
+        # entries are kept in insertion order and share one ttl, so the
+        # expired ones and the oldest ones are always at the front
+        now = time.time()
+        self.cache.pop(key, None)
+        self.cache[key] = (now, result)
+        while self.cache:
+            first = next(iter(self.cache.values()))
+            if now - first[0] < self.ttl and len(self.cache) <= self.maxcache:
+                break
+            self.cache.popitem(last=False)
+
+    def _queue(self, panel):
+        q = self._queues.get(panel)
+        if q is None:
+            q = self._queues[panel] = queue.Queue()
+            worker = threading.Thread(target=self._worker, args=(panel, q))
+            worker.daemon = True
+            worker.start()
+        return q
+
+    def _worker(self, panel, q):
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            key, read, flight = item
+            try:
+                client = self.sessions.get(panel)
+                if client is None:
+                    client = self.sessions[panel] = MeianClient(*self.panels[panel])
+                with client.deadline(self.timeout):
+                    flight['result'] = getattr(client, key[1])(*key[2], **dict(key[3]))
+            except (ConnectionError, LoginError, socket.error) as e:
+                self.sessions.pop(panel, None)
+                flight['error'] = e
+            except Exception as e:
+                flight['error'] = e
+            with self._lock:
+                self.stats['calls'] += 1
+                if flight['error'] is not None:
+                    self.stats['errors'] += 1
+                if read:
+                    self._inflight.pop(key, None)
+                    if flight['error'] is None:
+                        self._store(key, flight['result'])
+                else:
+                    for k in [k for k in self.cache if k[0] == panel]:
+                        del self.cache[k]
+            flight['done'].set()
+
+    def _handler(self):
+        import hmac
+        import http.server
+        import json
+        import urllib.parse
+        gateway = self
+        token = ('Bearer %s' % self.token).encode()
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                self._call(False)
+
+            def do_POST(self):
+                self._call(True)
+
+            def log_message(self, format, *args):
+                pass
+
+            def _call(self, post):
+                if not hmac.compare_digest(self.headers.get('Authorization', '').encode(), token):
+                    return self._reply(401, {'Error': 'Unauthorized'})
+                url = urllib.parse.urlsplit(self.path)
+                parts = [p for p in url.path.split('/') if p]
+                if not parts:
+                    return self._reply(200, sorted(gateway.panels))
+                if parts == ['stats']:
+                    return self._reply(200, gateway.stats)
+                if len(parts) != 2:
+                    return self._reply(404, {'Error': 'Not found'})
+                panel, command = parts
+                if panel not in gateway.panels or command not in gateway.commands:
+                    return self._reply(404, {'Error': 'Not found'})
+                if not post and not command.startswith('Get'):
+                    return self._reply(405, {'Error': 'Use POST for %s' % command})
+                args, kwargs = [], dict()
+                try:
+                    for k, v in urllib.parse.parse_qsl(url.query):
+                        kwargs[k] = self._value(v)
+                    size = int(self.headers.get('Content-Length') or 0)
+                    if size:
+                        body = json.loads(self.rfile.read(size).decode())
+                        if isinstance(body, list):
+                            args = body
+                        else:
+                            kwargs.update(body)
+                except ValueError as e:
+                    return self._reply(400, {'Error': str(e)})
+                try:
+                    self._reply(200, gateway.call(panel, command, *args, **kwargs))
+                except (KeyError, AttributeError):
+                    self._reply(404, {'Error': 'Not found'})
+                except TypeError as e:
+                    self._reply(400, {'Error': str(e)})
+                except DeadlineError as e:
+                    self._reply(504, {'Error': str(e)})
+                except Exception as e:
+                    self._reply(502, {'Error': str(e) or e.__class__.__name__})
+
+            def _value(self, v):
+                try:
+                    return json.loads(v)
+                except ValueError:
+                    return v
+
+            def _reply(self, code, data):
+                body = json.dumps(gateway._plain(data)).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def _plain(self, value):
+        if isinstance(value, time.struct_time):
+            return time.strftime('%Y-%m-%d %H:%M:%S', value)
+        if isinstance(value, (bytes, bytearray)):
+            return value.decode(errors='replace')
+        if isinstance(value, dict):
+            return dict((k, self._plain(v)) for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return [self._plain(v) for v in value]
+        return value
+
+class MeianShards():
+
+    batch = 256
+    flush = 0.1
+    report = 5
+
+    def __init__(self, panels, workers = None, handler = None, commands = None, push = True):
+        if handler is not None and not callable(handler):
+            raise AttributeError('handler is not a function')
+        self.panels = dict(panels)
+        self.workers = workers or os.cpu_count() or 1
+        self.handler = handler
+        self.commands = commands
+        self.push = push
+        self.events = queue.Queue()
+        self.shards = dict()
+        self.processes = []
+        self._queue = None
+        self._halt = None
+        self._collector = None
+        self.failed = 0
+        self.failure = None
+
+    def __iter__(self):
+        while self._collector is not None and self._collector.is_alive() or not self.events.empty():
+            try:
+                yield self.events.get(timeout=self.flush)
+            except queue.Empty:
+                pass
+
+    def shard(self, name):
+        return zlib.crc32(str(name).encode()) % self.workers
+
+    def start(self):
+        import multiprocessing
+        self._queue = multiprocessing.Queue()
+        self._halt = multiprocessing.Event()
+        assigned = [dict() for i in range(self.workers)]
+        for name, spec in self.panels.items():
+            assigned[self.shard(name)][name] = spec
+        for i in range(self.workers):
+            p = multiprocessing.Process(target=_shard, args=(i, assigned[i], self._queue, self._halt, self.commands, self.push, self.batch, self.flush, self.report))
+            p.daemon = True
+            p.start()
+            self.processes.append(p)
+            self.shards[i] = dict(pid=p.pid, panels=len(assigned[i]), events=0, updated=None)
+        self._collector = threading.Thread(target=self._collect)
+        self._collector.daemon = True
+        self._collector.start()
+
+    def stop(self, timeout = None):
+        self._halt.set()
+        for p in self.processes:
+            p.join(timeout)
+        self._queue.put(None)
+        self._collector.join(timeout)
+
+    def health(self):
+        total = dict(panels=0, connected=0, failing=0, events=0, errors=0, restarts=0, cpu=0.0)
+        shards = dict()
+        for i, stats in self.shards.items():
+            stats = dict(stats)
+            stats['alive'] = self.processes[i].is_alive()
+            shards[i] = stats
+            for k in total:
+                total[k] += stats.get(k) or 0
+        total['alive'] = sum(1 for s in shards.values() if s['alive'])
+        return dict(total=total, shards=shards)
+
+    def _collect(self):
+        while True:
+            msg = self._queue.get()
+            if msg is None:
+                break
+            kind, index, data = msg
+            if kind == 'health':
+                data['updated'] = time.time()
+                self.shards[index].update(data)
+                continue
+            for event in data:
+                event['Shard'] = index
+                if self.handler is None:
+                    self.events.put(event)
+                    continue
+                try:
+                    self.handler(event)
+                except Exception as e:
+                    self.failed += 1
+                    self.failure = e
+
+def _shard(index, panels, out, halt, commands, push, size, flush, report):
+    lock = threading.Lock()
+    batch = []
+    stats = dict(pid=os.getpid(), panels=len(panels), connected=0, failing=0, events=0, errors=0, restarts=0, cpu=0.0)
+
+    def emit(kind, panel, data):
+        nonlocal batch
+        event = OD()
+        event['Panel'] = panel
+        event['Type'] = kind
+        event['Data'] = data
+        with lock:
+            batch.append(event)
+            stats['events'] += 1
+            if len(batch) >= size:
+                out.put(('events', index, batch))
+                batch = []
+
+    def alive(name):
+        state = poller.panels.get(name)
+        if state is None or state['client'] is None or state['error'] is not None:
+            return False
+        if push:
+            pusher = pushers.get(name)
+            return pusher is not None and pusher.is_alive() and pusher.connected
+        return True
+
+    poller = MeianPoller(lambda delta: emit('Delta', delta['Panel'], delta))
+    poller.start()
+    # the poller reconnects its own sessions through the factory
+    for name, spec in panels.items():
+        poller.add(name, None, commands, factory=lambda spec = spec: MeianClient(*spec))
+    pushers = dict()
+    last = 0
+    while not halt.is_set():
+        now = time.time()
+        if now - last >= report:
+            last = now
+            for name, spec in panels.items():
+                if not push:
+                    break
+                pusher = pushers.get(name)
+                if pusher is not None and pusher.is_alive():
+                    continue
+                if pusher is not None:
+                    stats['restarts'] += 1
+                    pusher.close()
+                try:
+                    handler = lambda alarm, name = name: emit('Alarm', name, alarm)
+                    pushers[name] = MeianPushClient(spec[0], spec[1], spec[2], handler)
+                except Exception:
+                    stats['errors'] += 1
+            stats['connected'] = sum(1 for name in panels if alive(name))
+            stats['failing'] = sum(1 for state in list(poller.panels.values()) if state['error'] is not None)
+            stats['cpu'] = time.process_time()
+            out.put(('health', index, dict(stats)))
+        with lock:
+            if batch:
+                out.put(('events', index, batch))
+                batch = []
+        halt.wait(flush)
+    poller.stop()
+    for pusher in pushers.values():
+        pusher.close()
+    with lock:
+        if batch:
+            out.put(('events', index, batch))
+    out.close()
+    out.join_thread()
 
 def BOL(en):
     if en == True:
@@ -852,20 +2498,51 @@ def S32(val, pos = 0):
     return 'S32,%d,%d|%d' % (pos, pos, val)
 
 def MAC(mac):
-    return 'MAC,%d|%d' % (len(mac), mac)
+    return 'MAC,%d|%s' % (len(mac), mac)
 
 def IPA(ip):
-    return 'IPA,%d|%d' % (len(ip), ip)
+    return 'IPA,%d|%s' % (len(ip), ip)
+
+def NUM(num):
+    num = str(num)
+    return 'NUM,%d,%d|%s' % (len(num), len(num), num)
 
 def STR(text):
     text = str(text)
     return 'STR,%d|%s' % (len(text), text)
 
 def TYP(val, typ = []):
-    try:
+    if 0 <= val < len(typ):
         return 'TYP,%s|%d' % (typ[val], val)
-    except IndexError:
-        return 'TYP,NONE,|%d' % val
+    return 'TYP,NONE|%d' % val
+
+def _bol(value):
+    return value == 'T'
+
+def _dta(value):
+    return time.strptime(value, '%Y.%m.%d.%H.%M.%S')
+
+def _gba(value):
+    return bytearray.fromhex(value).decode()
+
+def _hma(value):
+    return time.strptime(value, '%H:%M')
+
+_types = {
+    'BOL': (re.compile(r'BOL\|([FT])'), 1, _bol),
+    'DTA': (re.compile(r'DTA(,\d+)*\|(\d{4}\.\d{2}.\d{2}.\d{2}.\d{2}.\d{2})'), 2, _dta),
+    'ERR': (re.compile(r'ERR\|(\d{2})'), 1, int),
+    'GBA': (re.compile(r'GBA,(\d+)\|([0-9A-F]*)'), 2, _gba),
+    'HMA': (re.compile(r'HMA,(\d+)\|(\d{2}:\d{2})'), 2, _hma),
+    'IPA': (re.compile(r'IPA,(\d+)\|(([0-2]?\d{0,2}\.){3}([0-2]?\d{0,2}))'), 2, str),
+    'MAC': (re.compile(r'MAC,(\d+)\|(([0-9A-F]{2}[:-]){5}([0-9A-F]{2}))'), 2, str),
+    'NEA': (re.compile(r'NEA,(\d+)\|([0-9A-F]+)'), 2, str),
+    'NUM': (re.compile(r'NUM,(\d+),(\d+)\|(\d*)'), 3, str),
+    'PWD': (re.compile(r'PWD,(\d+)\|(.*)', re.S), 2, str),
+    'S32': (re.compile(r'S32,(\d+),(\d+)\|(-?\d*)'), 3, int),
+    'STR': (re.compile(r'STR,(\d+)\|(.*)', re.S), 2, str),
+    'TYP': (re.compile(r'TYP,(\w+)\|(-?\d+)'), 2, int),
+}
 
 Cid = { '1100': 'Personal ambulance',
         '1101': 'Emergency',
@@ -902,6 +2579,19 @@ Cid = { '1100': 'Personal ambulance',
         '3570': 'Bypass recovery',
     }
 
+def _severity(cid):
+    if cid[1:2] in ('4', '5', '6'):
+        return 'info'
+    if cid[:1] == '3':
+        return 'restore'
+    if cid[:2] == '11':
+        return 'alarm'
+    if cid[:2] == '13':
+        return 'trouble'
+    return 'info'
+
+Severity = dict((cid, _severity(cid)) for cid in Cid)
+
 TZ = {  0: 'GMT-12:00',
         1: 'GMT-11:00',
         2: 'GMT-10:00',
@@ -995,6 +2685,32 @@ def main():
         time.sleep(60)
     mypush.close()
 
+def replay(path, speed = None):
+    t = time.time()
+    r = MeianReplay(path, speed=speed)
+    r.run()
+    t = time.time() - t
+    print ('%d frames, %d alarms, %d bytes in %.3fs' % (r.frames, r.alarms, r.bytes, t))
+
+def gateway(port, specs):
+    panels = dict()
+    for spec in specs:
+        name, _, spec = spec.rpartition('=')
+        cred, _, addr = spec.rpartition('@')
+        uid, _, pwd = cred.partition(':')
+        host, _, hport = addr.partition(':')
+        panels[name or host] = (host, int(hport or 18034), uid, pwd)
+    token = os.environ.get('MEIAN_GATEWAY_TOKEN')
+    if not token:
+        sys.exit('set MEIAN_GATEWAY_TOKEN to the shared secret clients must send as a bearer token')
+    bind, _, port = str(port).rpartition(':')
+    MeianGateway(panels, token, (bind or '127.0.0.1', int(port))).serve_forever()
+
 if __name__ == "__main__":
     # execute only if run as a script
-    main()
+    if len(sys.argv) > 2 and sys.argv[1] == 'replay':
+        replay(sys.argv[2], float(sys.argv[3]) if len(sys.argv) > 3 else None)
+    elif len(sys.argv) > 3 and sys.argv[1] == 'gateway':
+        gateway(sys.argv[2], sys.argv[3:])
+    else:
+        main()